@@ -1,20 +1,30 @@
+import hashlib
 import os
+import tempfile
 from datetime import timedelta
 from functools import wraps
 
 from flask import (
     Flask, render_template, request, redirect, url_for, flash,
-    jsonify, send_from_directory
+    jsonify
 )
 from flask_mail import Mail, Message
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash
 from sqlalchemy import desc
 
-from config import SECRET_KEY, UPLOAD_FOLDER, SQLALCHEMY_DATABASE_URI
+from config import (
+    SECRET_KEY, UPLOAD_FOLDER, LEAF_UPLOAD_FOLDER, SQLALCHEMY_DATABASE_URI, SIMILAR_CASES_K,
+    DEFAULT_MODEL_TIER, MODEL_TIER_FALLBACK
+)
 from models import db, User, SensorReading
 from auth import login_user, logout_user, current_user
-from predict import predict_rice_disease
+from assets import init_app as init_assets, send_cached
+from metrics import init_app as init_metrics, INGEST_ROWS, INGEST_SECONDS
+from profiling import init_app as init_profiling
+import storage
+from predict import classify, available_tiers
+from embedding_index import get_index
 from disease_solutions import disease_solutions
 from nutrients import analyze_nutrient_level, save_sensor_row, DEFAULT_MOISTURE_MIN
 
@@ -25,7 +35,9 @@ app = Flask(__name__)
 app.secret_key = SECRET_KEY
 app.config["SQLALCHEMY_DATABASE_URI"] = SQLALCHEMY_DATABASE_URI
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+storage.configure(app)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+app.config["LEAF_UPLOAD_FOLDER"] = LEAF_UPLOAD_FOLDER
 app.permanent_session_lifetime = timedelta(days=7)
 
 # Mail (use env vars for creds)
@@ -39,6 +51,11 @@ app.config.update(
 
 mail = Mail(app)
 db.init_app(app)
+storage.init_app(app, db)
+init_assets(app, {"static": app.static_folder, "uploaded_file": UPLOAD_FOLDER,
+                  "leaf_image": LEAF_UPLOAD_FOLDER})
+init_metrics(app)
+init_profiling(app)
 
 with app.app_context():
     db.create_all()
@@ -55,6 +72,30 @@ def login_required(route_func):
         return route_func(*args, **kwargs)
     return wrapper
 
+def save_leaf_upload(file):
+    """
+    Save a leaf image in LEAF_UPLOAD_FOLDER under a name derived from its
+    content. Names never get reused for a different image, so the embedding
+    index (keyed by filename) stays in step with the folder; re-uploading the
+    same image reuses its row. The upload is streamed, never held in memory.
+    """
+    folder = app.config["LEAF_UPLOAD_FOLDER"]
+    digest = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in iter(lambda: file.stream.read(64 * 1024), b""):
+                digest.update(chunk)
+                f.write(chunk)
+        filename = f"{digest.hexdigest()[:16]}_{secure_filename(file.filename) or 'leaf.jpg'}"
+        path = os.path.join(folder, filename)
+        os.chmod(tmp, 0o644)   # mkstemp creates 0600; match what file.save() would leave
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return filename, path
+
 # -----------------------------------------------------------------------------
 # Routes - Public / Auth
 # -----------------------------------------------------------------------------
@@ -266,22 +307,40 @@ def rice_disease():
     confidence = None
     solution = None
     filename = None
+    similar = []
+    result = None
+    tiers = available_tiers()
+    # Without the default's checkpoint, fall back to the most accurate tier that can run.
+    default_tier = DEFAULT_MODEL_TIER
+    if tiers and DEFAULT_MODEL_TIER not in tiers:
+        default_tier = next((t for t in MODEL_TIER_FALLBACK if t in tiers), tiers[0])
+    tier = request.form.get("tier") or default_tier
     if request.method == "POST":
         file = request.files.get("image")
         if not file or file.filename == "":
             flash("Please choose an image.", "error")
             return redirect(url_for("rice_disease"))
-        filename = secure_filename(file.filename)
-        save_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-        file.save(save_path)
+        if tier not in tiers:
+            flash(f"Model '{tier}' is not available.", "error")
+            return redirect(url_for("rice_disease"))
+        filename, save_path = save_leaf_upload(file)
 
         try:
-            prediction, confidence = predict_rice_disease(save_path)
+            result = classify(save_path, tier)
+            prediction, confidence = result.label, result.confidence
             solution = disease_solutions.get(prediction)
         except Exception as e:
             flash(f"Prediction error: {e}", "error")
             return redirect(url_for("rice_disease"))
 
+        # Similar past cases are a nice-to-have; never fail the diagnosis on them.
+        try:
+            index = get_index(result.tier)
+            similar = index.search(result.embedding, k=SIMILAR_CASES_K, label=prediction, exclude=filename)
+            index.add(result.embedding, prediction, filename)
+        except Exception as e:
+            app.logger.warning("similar-case lookup failed: %s", e)
+
     return render_template(
         "rice_disease.html",
         user=current_user(),
@@ -289,6 +348,10 @@ def rice_disease():
         confidence=confidence,
         solution=solution,
         filename=filename,
+        similar=similar,
+        result=result,
+        tiers=tiers,
+        tier=tier,
     )
 
 # -----------------------------------------------------------------------------
@@ -380,7 +443,11 @@ def soil_report():
 # -----------------------------------------------------------------------------
 @app.route("/uploads/<filename>")
 def uploaded_file(filename):
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+    return send_cached(app.config["UPLOAD_FOLDER"], filename)
+
+@app.route("/uploads/leaves/<filename>")
+def leaf_image(filename):
+    return send_cached(app.config["LEAF_UPLOAD_FOLDER"], filename)
 
 @app.route("/ping")
 def ping():
@@ -405,7 +472,9 @@ def api_ingest():
         return jsonify({"ok": False, "error": f"Missing fields: {', '.join(missing)}"}), 400
 
     # IMPORTANT: match nutrients.save_sensor_row signature
-    row = save_sensor_row(db, SensorReading, payload)
+    with INGEST_SECONDS.time():
+        row = save_sensor_row(db, SensorReading, payload)
+    INGEST_ROWS.inc()
     return jsonify({"ok": True, "id": row.id})
 
 # -----------------------------------------------------------------------------
@@ -0,0 +1,150 @@
+import hashlib
+import mimetypes
+import os
+import threading
+
+from flask import request, send_from_directory, abort
+from werkzeug.security import safe_join
+
+from config import STATIC_MAX_AGE
+
+# -----------------------------------------------------------------------------
+# Content fingerprints
+# -----------------------------------------------------------------------------
+_digest_cache = {}
+_digest_lock = threading.Lock()
+
+def file_digest(path):
+    """
+    Return a sha256 hex digest of the file's contents, or None if missing.
+    Cached on (mtime, size) so repeated url_for() calls only cost a stat().
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _digest_cache.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _digest_lock:
+        _digest_cache[path] = (key, digest)
+    return digest
+
+def fingerprint(directory, filename):
+    """Short version token used as ?v=... on asset URLs."""
+    path = safe_join(directory, filename)
+    digest = file_digest(path) if path else None
+    return digest[:12] if digest else None
+
+# -----------------------------------------------------------------------------
+# Variant negotiation (precompressed .br / .gz, .webp images)
+# -----------------------------------------------------------------------------
+_ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+_WEBP_SOURCES = {".jpg", ".jpeg", ".png"}
+
+def negotiate_variant(directory, filename):
+    """
+    Pick the best file to send for the current request.
+    Returns (filename_on_disk, mimetype, content_encoding, vary_headers).
+    """
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    vary = []
+
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in _WEBP_SOURCES:
+        # Images are already compressed; the win is a smaller format.
+        vary.append("Accept")
+        webp = filename + ".webp"
+        if "image/webp" in request.headers.get("Accept", "") and _fresh_variant(directory, filename, webp):
+            return webp, "image/webp", None, vary
+        return filename, mimetype, None, vary
+
+    vary.append("Accept-Encoding")
+    for encoding, suffix in _ENCODINGS:
+        if request.accept_encodings[encoding] > 0 and _fresh_variant(directory, filename, filename + suffix):
+            return filename + suffix, mimetype, encoding, vary
+    return filename, mimetype, None, vary
+
+def _fresh_variant(directory, source, variant):
+    """
+    True if `variant` exists and is not older than `source`. Uploads can be
+    overwritten under the same name, leaving a variant of the previous file.
+    """
+    source_path = safe_join(directory, source)
+    variant_path = safe_join(directory, variant)
+    if not source_path or not variant_path or not os.path.isfile(variant_path):
+        return False
+    try:
+        return os.path.getmtime(variant_path) >= os.path.getmtime(source_path)
+    except OSError:
+        return False
+
+# -----------------------------------------------------------------------------
+# Sending
+# -----------------------------------------------------------------------------
+def send_cached(directory, filename):
+    """
+    send_from_directory with:
+      - strong, content-based ETag + If-None-Match / If-Modified-Since
+      - Range / If-Range (handled by werkzeug once conditional=True)
+      - immutable caching when the URL carries the current ?v= fingerprint,
+        otherwise revalidate on every use
+      - precompressed / WebP variants chosen by content negotiation
+    """
+    source = safe_join(directory, filename)
+    if not source or not os.path.isfile(source):
+        abort(404)
+
+    send_name, mimetype, encoding, vary = negotiate_variant(directory, filename)
+    etag = file_digest(safe_join(directory, send_name))
+
+    version = request.args.get("v")
+    immutable = bool(version) and version == fingerprint(directory, filename)
+
+    response = send_from_directory(
+        directory,
+        send_name,
+        mimetype=mimetype,
+        conditional=True,
+        etag=etag,
+        max_age=STATIC_MAX_AGE if immutable else 0,
+    )
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    for header in vary:
+        response.vary.add(header)
+
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+# -----------------------------------------------------------------------------
+# App wiring
+# -----------------------------------------------------------------------------
+def init_app(app, fingerprinted_endpoints):
+    """
+    fingerprinted_endpoints: {endpoint_name: directory}. url_for() on those
+    endpoints gets a ?v=<content hash> so the response can be cached forever.
+    """
+    @app.url_defaults
+    def add_fingerprint(endpoint, values):
+        directory = fingerprinted_endpoints.get(endpoint)
+        if directory is None or "v" in values or not values.get("filename"):
+            return
+        version = fingerprint(directory, values["filename"])
+        if version:
+            values["v"] = version
+
+    # Route Flask's built-in /static through the same cache-aware sender.
+    if app.static_folder:
+        app.view_functions["static"] = lambda filename: send_cached(app.static_folder, filename)
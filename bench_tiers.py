@@ -0,0 +1,106 @@
+"""
+Latency and agreement of each model tier on the sample images.
+
+    python bench_tiers.py                        # tiers with a checkpoint on disk
+    python bench_tiers.py --untrained            # all tiers, random weights (latency only)
+    python bench_tiers.py --thresholds 60 80 90  # cascade operating points
+
+Agreement is top-1 agreement with B4 (the reference). Cascade rows are
+derived from the measured runs: fast tier on every image, plus B4 wherever
+the fast tier's confidence is below the threshold.
+"""
+import argparse
+import glob
+import os
+import time
+
+from PIL import Image
+
+import predict
+from config import BASE_DIR, CASCADE_FAST_TIER
+from loadtest import percentile
+
+def run(args):
+    images = sorted(
+        p for p in glob.glob(os.path.join(args.images, "*"))
+        if p.lower().endswith((".jpg", ".jpeg", ".png"))
+    )
+    if not images:
+        raise SystemExit(f"no images in {args.images}")
+
+    tiers = args.tiers or [t for t in predict.MODEL_TIERS if args.untrained or os.path.exists(predict.checkpoint_path(t))]
+    missing = [t for t in tiers if not args.untrained and not os.path.exists(predict.checkpoint_path(t))]
+    if missing:
+        raise SystemExit("no checkpoint for " + ", ".join(
+            f"{t} ({os.path.relpath(predict.checkpoint_path(t), BASE_DIR)})" for t in missing
+        ) + "; train it first or pass --untrained")
+    for tier in tiers:
+        if args.untrained:
+            model, transform = predict.build_model(tier)
+            predict._models[tier] = (model.to(predict._device).eval(), transform)
+        else:
+            predict.load_model(tier)
+
+    decode = []
+    decoded = []
+    for path in images:
+        start = time.perf_counter()
+        decoded.append(Image.open(path).convert("RGB"))
+        decode.append(time.perf_counter() - start)
+
+    results = {}
+    for tier in tiers:
+        for image in decoded[:args.warmup]:
+            predict._run_tier(tier, image)
+        rows = []
+        for image, decode_s in zip(decoded, decode):
+            start = time.perf_counter()
+            result = predict._run_tier(tier, image)
+            rows.append((result.label, result.confidence, decode_s + time.perf_counter() - start))
+        results[tier] = rows
+
+    reference = results.get(predict.ACCURATE_TIER)
+    print(f"{len(images)} images from {os.path.relpath(args.images, BASE_DIR)}"
+          f"{' (untrained weights: latency only)' if args.untrained else ''}\n")
+    header = f"{'tier':<28}{'mean ms':>9}{'p50 ms':>9}{'p95 ms':>9}{'agree':>8}{'escal.':>8}"
+    print(header)
+    print("-" * len(header))
+
+    def line(name, latencies, labels, escalated=None):
+        latencies = sorted(latencies)
+        agree = (f"{sum(a == b for a, (b, _, _) in zip(labels, reference)) / len(labels) * 100:7.1f}%"
+                 if reference else f"{'-':>8}")
+        esc = f"{escalated * 100:7.1f}%" if escalated is not None else f"{'-':>8}"
+        print(f"{name:<28}{sum(latencies) / len(latencies) * 1000:>9.1f}"
+              f"{percentile(latencies, 50) * 1000:>9.1f}{percentile(latencies, 95) * 1000:>9.1f}{agree}{esc}")
+
+    for tier, rows in results.items():
+        line(predict.MODEL_TIERS[tier]["builder"] + f" ({predict.MODEL_TIERS[tier]['input_size']})",
+             [r[2] for r in rows], [r[0] for r in rows])
+
+    fast = results.get(args.fast_tier)
+    if fast and reference and args.fast_tier != predict.ACCURATE_TIER:
+        for threshold in args.thresholds:
+            latencies, labels, escalations = [], [], 0
+            for (f_label, f_conf, f_s), (r_label, _, r_s), decode_s in zip(fast, reference, decode):
+                if f_conf >= threshold:
+                    latencies.append(f_s)
+                    labels.append(f_label)
+                else:
+                    latencies.append(f_s + r_s - decode_s)   # image decoded once
+                    labels.append(r_label)
+                    escalations += 1
+            line(f"cascade {args.fast_tier}@{threshold:g}%", latencies, labels, escalations / len(fast))
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--images", default=os.path.join(BASE_DIR, "static", "uploads"))
+    ap.add_argument("--tiers", nargs="+", choices=list(predict.MODEL_TIERS))
+    ap.add_argument("--untrained", action="store_true", help="benchmark architectures without checkpoints")
+    ap.add_argument("--fast-tier", default=CASCADE_FAST_TIER, choices=list(predict.MODEL_TIERS))
+    ap.add_argument("--thresholds", nargs="+", type=float, default=[60.0, 80.0, 90.0])
+    ap.add_argument("--warmup", type=int, default=2)
+    run(ap.parse_args(argv))
+
+if __name__ == "__main__":
+    main()
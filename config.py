@@ -4,9 +4,58 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 UPLOAD_FOLDER = os.path.join(BASE_DIR, "static", "uploads")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Rice-disease images only (never profile photos); this is what the embedding index covers.
+LEAF_UPLOAD_FOLDER = os.path.join(UPLOAD_FOLDER, "leaves")
+os.makedirs(LEAF_UPLOAD_FOLDER, exist_ok=True)
 
-SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(BASE_DIR, "app.db")
+# Fingerprinted (?v=<hash>) static/upload URLs are cached this long (1 year)
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+SQLALCHEMY_DATABASE_URI = os.environ.get(
+    "DATABASE_URL", "sqlite:///" + os.path.join(BASE_DIR, "app.db")
+)
+
+# Storage profile (see storage.py): "sqlite", "sqlite-default" or "postgres".
+# Unset = inferred from the DATABASE_URL backend.
+STORAGE_PROFILE = os.environ.get("STORAGE_PROFILE")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))     # seconds
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))     # seconds (postgres)
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "1").lower() not in ("0", "false", "no")
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+SQLITE_CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_SIZE_KB", 64 * 1024))
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))   # bytes
 
 SECRET_KEY = "replace-this-with-a-secret-key"  # Change this in production
 
+# Model tiers (see predict.MODEL_TIERS): "b4", "b0", "mobilenet_v3" or "cascade"
+DEFAULT_MODEL_TIER = os.environ.get("DEFAULT_MODEL_TIER", "b4")
+# If the default's checkpoint is missing, use the first of these that is available
+MODEL_TIER_FALLBACK = ("cascade", "b4", "b0", "mobilenet_v3")   # most accurate first
+CASCADE_FAST_TIER = os.environ.get("CASCADE_FAST_TIER", "b0")
+CASCADE_THRESHOLD = float(os.environ.get("CASCADE_THRESHOLD", 80.0))   # % confidence to skip B4
+
+# Similar-case retrieval (embedding_index.py)
+EMBEDDING_INDEX_DIR = os.environ.get("EMBEDDING_INDEX_DIR", os.path.join(BASE_DIR, "embeddings"))
+EMBEDDING_APPROX_MIN_ROWS = int(os.environ.get("EMBEDDING_APPROX_MIN_ROWS", 50000))  # use IVF above this
+EMBEDDING_NPROBE = int(os.environ.get("EMBEDDING_NPROBE", 8))
+# Rebuild the IVF in the background once rows added since the last build exceed this share of it
+EMBEDDING_IVF_STALE_FRACTION = float(os.environ.get("EMBEDDING_IVF_STALE_FRACTION", 0.1))
+SIMILAR_CASES_K = 6
+
+# Comma-separated admin emails (may trigger per-request profiling)
+ADMIN_EMAILS = {
+    e.strip().lower() for e in os.environ.get("ADMIN_EMAILS", "").split(",") if e.strip()
+}
+
+# Profiling / slow-request log
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(BASE_DIR, "profiles"))
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", 200))                # newest files kept
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))  # 0.0 - 1.0
+SAMPLER_INTERVAL = float(os.environ.get("SAMPLER_INTERVAL", 0.01))     # seconds
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", 1.0))
+# Each process appends its pid: logs/slow_requests.<pid>.log
+SLOW_LOG_PATH = os.environ.get("SLOW_LOG_PATH", os.path.join(BASE_DIR, "logs", "slow_requests.log"))
+
 
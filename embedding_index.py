@@ -0,0 +1,417 @@
+"""
+Compact on-disk index of leaf-image embeddings for similar-case lookup.
+
+Layout of an index directory:
+    meta.json        {"dim": D, "rows": N, "names_bytes": B}, the committed state
+    vectors.f32      N x D float32, L2-normalised (memory-mapped for search)
+    labels.u8        N class ids (predict.class_names order)
+    names.txt        N upload filenames, one per line (each indexed once)
+    ivf.npz          optional inverted-file index for approximate search
+                     (k-means centroids, list offsets, row ids), replaced atomically
+
+Embeddings from different model tiers are not comparable, so each tier has
+its own index under EMBEDDING_INDEX_DIR/<tier>.
+
+Exact search is one matrix-vector product over the memmap (cosine
+similarity) plus argpartition. Approximate search scores only the rows in
+the `nprobe` closest k-means lists, plus any rows added since the IVF was
+built. Once an index reaches EMBEDDING_APPROX_MIN_ROWS, add() builds the IVF
+in a background thread, and rebuilds it whenever the rows added since exceed
+EMBEDDING_IVF_STALE_FRACTION of it, so that exactly-scanned tail stays small.
+
+A row is appended to the three data files and only then committed by
+atomically rewriting meta.json. Readers never look past the committed
+count. Writers first truncate the files back to it, so a crash mid-append
+cannot leave names and vectors out of step.
+
+CLI:
+    python embedding_index.py backfill [--tier b4]   # embed existing static/uploads/leaves
+    python embedding_index.py build-ivf [--tier b4]  # force an IVF rebuild now
+    python embedding_index.py bench --rows 100000
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from config import (
+    EMBEDDING_INDEX_DIR, EMBEDDING_APPROX_MIN_ROWS, EMBEDDING_IVF_STALE_FRACTION, EMBEDDING_NPROBE,
+)
+from metrics import SIMILAR_SEARCH_SECONDS
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process dev server only
+    fcntl = None
+
+log = logging.getLogger("ricehealth.embeddings")
+
+class EmbeddingIndex:
+    def __init__(self, directory, class_names):
+        self.directory = directory
+        self.class_names = list(class_names)
+        self._lock = threading.Lock()
+        self.dim = None
+        self._rows = 0
+        self._vectors = None
+        self._labels = np.zeros(0, dtype=np.uint8)
+        self._names = []
+        self._rows_by_name = {}
+        self._names_offset = 0
+        self._ivf = None
+        self._ivf_key = None
+        self._ivf_building = False
+
+    # -------------------------------------------------------------------------
+    # Files
+    # -------------------------------------------------------------------------
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read_meta(self):
+        try:
+            with open(self._path("meta.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self, meta):
+        tmp = self._path("meta.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path("meta.json"))
+
+    def _refresh(self):
+        """Pick up rows committed since the last call (by this or another process)."""
+        meta = self._read_meta()
+        if meta is None:
+            return
+        self.dim = meta["dim"]
+        rows = meta.get("rows", 0)
+        if rows != self._rows:
+            if rows < self._rows:   # index was rebuilt underneath us
+                self._names, self._rows_by_name, self._names_offset = [], {}, 0
+            with open(self._path("names.txt"), "rb") as f:
+                f.seek(self._names_offset)
+                committed = f.read(meta["names_bytes"] - self._names_offset)
+            for name in committed.decode("utf-8").splitlines():
+                self._rows_by_name.setdefault(name, []).append(len(self._names))
+                self._names.append(name)
+            self._names_offset = meta["names_bytes"]
+            self._vectors = np.memmap(self._path("vectors.f32"), dtype=np.float32, mode="r", shape=(rows, self.dim)) if rows else None
+            self._labels = np.fromfile(self._path("labels.u8"), dtype=np.uint8, count=rows)
+            self._rows = rows
+        self._load_ivf()
+
+    def _load_ivf(self):
+        try:
+            stat = os.stat(self._path("ivf.npz"))
+        except FileNotFoundError:
+            self._ivf, self._ivf_key = None, None
+            return
+        key = (stat.st_ino, stat.st_mtime_ns)   # a rebuild replaces the file
+        if key == self._ivf_key:
+            return
+        with np.load(self._path("ivf.npz")) as data:
+            self._ivf = {name: data[name] for name in ("centroids", "offsets", "ids")}
+            self._ivf["rows"] = int(data["rows"])
+        self._ivf_key = key
+
+    def _ivf_stale(self):
+        if self._rows < EMBEDDING_APPROX_MIN_ROWS:
+            return False
+        if self._ivf is None:
+            return True
+        return self._rows - self._ivf["rows"] > EMBEDDING_IVF_STALE_FRACTION * self._ivf["rows"]
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return self._rows
+
+    # -------------------------------------------------------------------------
+    # Writing
+    # -------------------------------------------------------------------------
+    def add(self, embedding, label, filename):
+        """Append one image; returns False if `filename` is already indexed."""
+        vector = _normalize(np.asarray(embedding, dtype=np.float32).ravel())
+        label_id = self.class_names.index(label)
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, open(self._path(".lock"), "w") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            meta = self._read_meta() or {"dim": int(vector.size), "rows": 0, "names_bytes": 0}
+            if vector.size != meta["dim"]:
+                raise ValueError(f"embedding has {vector.size} dims, index expects {meta['dim']}")
+
+            self._refresh()
+            if filename in self._rows_by_name:
+                return False
+
+            # Drop anything a failed earlier append left past the committed rows.
+            rows = meta["rows"]
+            for name, size in (("names.txt", meta["names_bytes"]), ("labels.u8", rows),
+                               ("vectors.f32", rows * meta["dim"] * 4)):
+                with open(self._path(name), "ab") as f:
+                    f.truncate(size)
+
+            line = filename.replace("\n", " ").encode("utf-8") + b"\n"
+            with open(self._path("names.txt"), "ab") as f:
+                f.write(line)
+            with open(self._path("labels.u8"), "ab") as f:
+                f.write(bytes([label_id]))
+            with open(self._path("vectors.f32"), "ab") as f:
+                f.write(vector.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            meta.update(rows=rows + 1, names_bytes=meta["names_bytes"] + len(line))
+            self._write_meta(meta)
+            self._refresh()
+            rebuild = not self._ivf_building and self._ivf_stale()
+            if rebuild:
+                self._ivf_building = True
+        if rebuild:
+            threading.Thread(target=self._rebuild_ivf, name="ivf-rebuild", daemon=True).start()
+        return True
+
+    # -------------------------------------------------------------------------
+    # Search
+    # -------------------------------------------------------------------------
+    def search(self, embedding, k=5, label=None, approximate=None, nprobe=EMBEDDING_NPROBE, exclude=None):
+        """
+        Top-k most similar stored images as [{"filename", "label", "score"}].
+        label: only consider images predicted as this class.
+        approximate: None = use the IVF automatically for large indexes.
+        exclude: filename to leave out (e.g. the image being queried).
+        """
+        with self._lock:
+            self._refresh()
+            rows, vectors, labels, names, ivf = self._rows, self._vectors, self._labels, self._names, self._ivf
+            excluded = np.array(self._rows_by_name.get(exclude, []), dtype=np.int64)
+        if not rows:
+            return []
+
+        query = _normalize(np.asarray(embedding, dtype=np.float32).ravel())
+        if approximate is None:
+            approximate = ivf is not None and rows >= EMBEDDING_APPROX_MIN_ROWS
+        mode = "approximate" if approximate and ivf is not None else "exact"
+
+        with SIMILAR_SEARCH_SECONDS.time(mode):
+            candidates = None
+            if mode == "approximate":
+                candidates = _ivf_candidates(ivf, query, nprobe, rows)
+            if label is not None:
+                mask = labels == self.class_names.index(label)
+                if candidates is not None:
+                    candidates = candidates[mask[candidates]]
+                # Probed lists may hold too few of this class; fall back to a filtered scan.
+                if candidates is None or len(candidates) < k:
+                    candidates = np.flatnonzero(mask)
+
+            if candidates is None:
+                scores = vectors @ query
+                candidates = np.arange(rows)
+            else:
+                scores = vectors[candidates] @ query
+
+            hidden = 0
+            if len(excluded):   # every row stored under that name, however many
+                mask = np.isin(candidates, excluded)
+                scores[mask] = -np.inf
+                hidden = int(mask.sum())
+            want = min(len(scores) - hidden, k)
+            if want <= 0:
+                return []
+            top = np.argpartition(-scores, want - 1)[:want]
+            top = top[np.argsort(-scores[top])]
+
+        return [{
+            "filename": names[int(candidates[i])],
+            "label": self.class_names[labels[int(candidates[i])]],
+            "score": float(scores[i]),
+        } for i in top]
+
+    # -------------------------------------------------------------------------
+    # Approximate index
+    # -------------------------------------------------------------------------
+    def _rebuild_ivf(self):
+        """Background rebuild; one process at a time, searches keep using the old lists."""
+        try:
+            with open(self._path(".ivf.lock"), "w") as lock_file:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:   # another worker is already rebuilding
+                        return
+                with self._lock:
+                    self._refresh()
+                    stale = self._ivf_stale()   # it may have just finished one
+                if stale:
+                    start = time.perf_counter()
+                    n_lists = self.build_ivf()
+                    log.info("rebuilt IVF for %s: %d lists in %.1fs", self.directory, n_lists, time.perf_counter() - start)
+        except Exception:
+            log.exception("IVF rebuild failed for %s", self.directory)
+        finally:
+            with self._lock:
+                self._ivf_building = False
+
+    def build_ivf(self, n_lists=None, iterations=10, sample_size=20000, seed=0):
+        """Spherical k-means over a sample; every row goes to its closest list."""
+        with self._lock:
+            self._refresh()
+            rows, vectors = self._rows, self._vectors
+        if not rows:
+            raise ValueError("index is empty")
+        n_lists = n_lists or max(1, min(rows // 40, int(4 * np.sqrt(rows))))
+        rng = np.random.default_rng(seed)
+
+        sample = np.asarray(vectors[np.sort(rng.choice(rows, min(rows, max(sample_size, n_lists)), replace=False))])
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            counts = np.bincount(assign, minlength=n_lists)
+            empty = counts == 0
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            centroids = _normalize(sums)
+
+        assign = np.concatenate([
+            np.argmax(np.asarray(vectors[start:start + 8192]) @ centroids.T, axis=1)
+            for start in range(0, rows, 8192)
+        ])
+        order = np.argsort(assign, kind="stable").astype(np.int32)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=n_lists))]).astype(np.int64)
+
+        # One file, swapped in whole, so readers never see a half-written IVF.
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".npz.tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, rows=np.int64(rows), centroids=centroids.astype(np.float32), offsets=offsets, ids=order)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path("ivf.npz"))
+        return n_lists
+
+def _normalize(x):
+    norm = np.linalg.norm(x, axis=-1, keepdims=True)
+    return (x / np.where(norm > 0, norm, 1)).astype(np.float32)
+
+def _ivf_candidates(ivf, query, nprobe, rows):
+    centroid_scores = ivf["centroids"] @ query
+    nprobe = min(nprobe, len(centroid_scores))
+    probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+    offsets, ids = ivf["offsets"], ivf["ids"]
+    parts = [ids[offsets[p]:offsets[p + 1]] for p in probe]
+    # Rows added after the IVF was built are always scanned exactly.
+    parts.append(np.arange(ivf["rows"], rows, dtype=np.int32))
+    return np.sort(np.concatenate(parts))
+
+# -----------------------------------------------------------------------------
+# Default index used by the app
+# -----------------------------------------------------------------------------
+_indexes = {}
+
+def get_index(tier):
+    if tier not in _indexes:
+        from predict import class_names
+        _indexes[tier] = EmbeddingIndex(os.path.join(EMBEDDING_INDEX_DIR, tier), class_names)
+    return _indexes[tier]
+
+# -----------------------------------------------------------------------------
+# CLI
+# -----------------------------------------------------------------------------
+def _backfill(args):
+    from config import LEAF_UPLOAD_FOLDER
+    from predict import predict_with_embedding
+
+    index = get_index(args.tier)
+    index._refresh()
+    known = set(index._rows_by_name)
+    added = 0
+    # Leaf uploads only: profile photos live in the parent folder and must never be indexed.
+    for name in sorted(os.listdir(LEAF_UPLOAD_FOLDER)):
+        if name in known or not name.lower().endswith((".jpg", ".jpeg", ".png")):
+            continue
+        label, _, embedding = predict_with_embedding(os.path.join(LEAF_UPLOAD_FOLDER, name), args.tier)
+        added += index.add(embedding, label, name)
+    print(f"added {added} image(s); index has {len(index)} rows")
+
+def _build_ivf(args):
+    index = get_index(args.tier)
+    n_lists = index.build_ivf(n_lists=args.lists)
+    print(f"built IVF with {n_lists} lists over {len(index)} rows")
+
+def _bench(args):
+    from predict import class_names
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        index = EmbeddingIndex(tmp, class_names)
+        # Clustered synthetic data, written in bulk in the on-disk layout.
+        centers = _normalize(rng.standard_normal((200, args.dim)).astype(np.float32))
+        owner = rng.integers(0, len(centers), args.rows)
+        with open(os.path.join(tmp, "vectors.f32"), "wb") as f:
+            for start in range(0, args.rows, 10000):
+                chunk = centers[owner[start:start + 10000]]
+                noise = rng.standard_normal(chunk.shape, dtype=np.float32) * 0.02
+                f.write(_normalize(chunk + noise).tobytes())
+        (owner % len(class_names)).astype(np.uint8).tofile(os.path.join(tmp, "labels.u8"))
+        with open(os.path.join(tmp, "names.txt"), "w") as f:
+            f.writelines(f"img_{i}.jpg\n" for i in range(args.rows))
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump({"dim": args.dim, "rows": args.rows,
+                       "names_bytes": os.path.getsize(os.path.join(tmp, "names.txt"))}, f)
+
+        start = time.perf_counter()
+        n_lists = index.build_ivf()
+        print(f"{args.rows} x {args.dim} rows; IVF build ({n_lists} lists): {time.perf_counter() - start:.1f}s")
+
+        index._refresh()
+        sample = np.sort(rng.choice(args.rows, args.queries, replace=False))
+        queries = np.asarray(index._vectors[sample])
+        query_labels = [class_names[i] for i in index._labels[sample]]
+        index.search(queries[0], approximate=False)  # warm the page cache
+        for mode, approx, by_class in [("exact", False, False), ("exact+class", False, True),
+                                       ("approx", True, False), ("approx+class", True, True)]:
+            timings, recall = [], []
+            for q, q_label in zip(queries, query_labels):
+                label = q_label if by_class else None
+                start = time.perf_counter()
+                got = index.search(q, k=args.k, label=label, approximate=approx)
+                timings.append(time.perf_counter() - start)
+                if approx:
+                    truth = index.search(q, k=args.k, label=label, approximate=False)
+                    truth_names = {r["filename"] for r in truth}
+                    recall.append(len(truth_names & {r["filename"] for r in got}) / max(1, len(truth_names)))
+            timings.sort()
+            line = f"{mode:<14} p50 {timings[len(timings) // 2] * 1000:7.2f} ms   p95 {timings[int(len(timings) * 0.95)] * 1000:7.2f} ms"
+            if recall:
+                line += f"   recall@{args.k} {np.mean(recall):.3f}"
+            print(line)
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("backfill", help="embed images in static/uploads/leaves that are not indexed yet")
+    p.add_argument("--tier", default="b4")
+    p = sub.add_parser("build-ivf", help="(re)build the approximate index")
+    p.add_argument("--tier", default="b4")
+    p.add_argument("--lists", type=int, help="number of k-means lists (default ~4*sqrt(N))")
+    p = sub.add_parser("bench", help="search latency on a synthetic index")
+    p.add_argument("--rows", type=int, default=100000)
+    p.add_argument("--dim", type=int, default=1792)   # EfficientNet-B4 penultimate width
+    p.add_argument("--queries", type=int, default=50)
+    p.add_argument("--k", type=int, default=5)
+    args = ap.parse_args(argv)
+    {"backfill": _backfill, "build-ivf": _build_ivf, "bench": _bench}[args.command](args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+"""
+Load-test harness: a simulated ESP32 fleet plus dashboard and upload users.
+
+    # against a running server
+    python loadtest.py --base-url http://127.0.0.1:8000 --email me@x.com --password ...
+
+    # spin up app.py in-process on a temp DB with a stub model
+    python loadtest.py --serve --stub-model --devices 200 --dashboards 20 --uploaders 4
+
+Traffic:
+  - N devices POST the esp.ino JSON payload to /api/ingest every --device-interval s
+  - M dashboards GET /soil-data and /api/sensor-readings every --poll-interval s
+  - U uploaders (logged in) POST a sample leaf image to /rice-disease
+
+Reports requests, sustained throughput, error rate and latency percentiles
+per endpoint. A rising p99 or error rate as --devices grows marks the point
+where a single box stops keeping up.
+"""
+import argparse
+import glob
+import http.cookiejar
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_IMAGES = sorted(
+    p for p in glob.glob(os.path.join(BASE_DIR, "static", "uploads", "*"))
+    if p.lower().endswith((".jpg", ".jpeg", ".png"))
+)
+LOADTEST_EMAIL = "loadtest@example.com"
+LOADTEST_PASSWORD = "loadtest"
+
+# -----------------------------------------------------------------------------
+# Stats
+# -----------------------------------------------------------------------------
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.error_samples = {}
+
+    def record(self, endpoint, seconds, ok, detail=None):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+                self.error_samples.setdefault(endpoint, detail)
+
+    def summary(self, elapsed):
+        rows = []
+        with self._lock:
+            for endpoint, values in sorted(self.latencies.items()):
+                values = sorted(values)
+                errors = self.errors.get(endpoint, 0)
+                rows.append({
+                    "endpoint": endpoint,
+                    "requests": len(values),
+                    "errors": errors,
+                    "error_rate": errors / len(values),
+                    "rps": len(values) / elapsed,
+                    "p50_ms": percentile(values, 50) * 1000,
+                    "p90_ms": percentile(values, 90) * 1000,
+                    "p99_ms": percentile(values, 99) * 1000,
+                    "max_ms": values[-1] * 1000,
+                    "first_error": self.error_samples.get(endpoint),
+                })
+        return rows
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[idx]
+
+# -----------------------------------------------------------------------------
+# HTTP client
+# -----------------------------------------------------------------------------
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+class Client:
+    """Cookie-keeping client that does not follow redirects (so 302s are visible)."""
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect()
+        )
+
+    def request(self, method, path, body=None, headers=None):
+        """Returns (status, headers, body). Network failures raise OSError."""
+        req = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers or {})
+        try:
+            with self.opener.open(req, timeout=self.timeout) as resp:
+                return resp.status, resp.headers, resp.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+def _multipart(field, filename, data, content_type="image/jpeg"):
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return body, {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+def timed_call(stats, endpoint, fn, ok_statuses=(200,)):
+    start = time.perf_counter()
+    try:
+        status, headers, body = fn()
+        ok = status in ok_statuses
+        detail = None if ok else f"HTTP {status}"
+    except OSError as e:
+        status, headers, body, ok, detail = None, None, None, False, repr(e)
+    stats.record(endpoint, time.perf_counter() - start, ok, detail)
+    return status, headers, body
+
+# -----------------------------------------------------------------------------
+# Simulated actors
+# -----------------------------------------------------------------------------
+def esp_payload():
+    """Same fields and ranges the ESP32 sketch (esp/esp.ino) sends."""
+    return {
+        "nitrogen": random.randint(20, 160),
+        "phosphorus": random.randint(5, 60),
+        "potassium": random.randint(50, 260),
+        "moisture": random.randint(10, 90),
+        "temperature": round(random.uniform(18, 38), 2),
+        "humidity": round(random.uniform(40, 95), 2),
+        "ph": round(random.uniform(4.5, 8.0), 2),
+    }
+
+def _every(interval, stop, fn):
+    # Random phase so N actors don't fire in lock-step.
+    if stop.wait(random.uniform(0, interval)):
+        return
+    while not stop.is_set():
+        start = time.monotonic()
+        fn()
+        stop.wait(max(0.0, interval - (time.monotonic() - start)))
+
+def device(args, stats, stop):
+    client = Client(args.base_url, args.timeout)
+
+    def post():
+        body = json.dumps(esp_payload()).encode()
+        timed_call(stats, "POST /api/ingest", lambda: client.request(
+            "POST", "/api/ingest", body, {"Content-Type": "application/json"}))
+    _every(args.device_interval, stop, post)
+
+def dashboard(args, stats, stop):
+    client = Client(args.base_url, args.timeout)
+
+    def poll():
+        timed_call(stats, "GET /soil-data", lambda: client.request("GET", "/soil-data"))
+        timed_call(stats, "GET /api/sensor-readings", lambda: client.request(
+            "GET", f"/api/sensor-readings?limit={args.readings_limit}"))
+    _every(args.poll_interval, stop, poll)
+
+def uploader(index, args, stats, stop):
+    client = Client(args.base_url, args.timeout)
+    status, headers, _ = timed_call(stats, "POST /login", lambda: client.request(
+        "POST", "/login",
+        urllib.parse.urlencode({"email": args.email, "password": args.password}).encode(),
+        {"Content-Type": "application/x-www-form-urlencoded"},
+    ), ok_statuses=(302,))
+    if status != 302 or "/login" in headers.get("Location", "") or "/register" in headers.get("Location", ""):
+        print(f"uploader {index}: login failed for {args.email}", file=sys.stderr)
+        return
+
+    images = [open(p, "rb").read() for p in SAMPLE_IMAGES] or [b""]
+
+    def upload():
+        # The app stores uploads by content hash, so the few sample images map to
+        # a fixed set of files and index rows however long the run is.
+        body, hdrs = _multipart("image", f"loadtest_{index}.jpg", random.choice(images))
+        # 200 renders the result; a 302 back to the form means the upload/prediction failed.
+        timed_call(stats, "POST /rice-disease", lambda: client.request("POST", "/rice-disease", body, hdrs))
+    _every(args.upload_interval, stop, upload)
+
+# -----------------------------------------------------------------------------
+# In-process server
+# -----------------------------------------------------------------------------
+def _install_stub_model(latency):
+    stub = types.ModuleType("predict")
+    stub.class_names = ["normal"]
+
+    def classify(image_path, tier=None):
+        time.sleep(latency)
+        return types.SimpleNamespace(
+            label="normal", confidence=99.0, embedding=[random.random() for _ in range(16)],
+            tier="b4", escalated=False,
+        )
+    stub.classify = classify
+    stub.available_tiers = lambda: ["b4"]
+    sys.modules["predict"] = stub
+
+def serve(args):
+    """Start app.py on a temp SQLite DB and upload folder; returns base URL."""
+    tmp = tempfile.mkdtemp(prefix="ricehealth-loadtest-")
+    # Overwrite, never inherit: the shell may point these at production data.
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tmp, "app.db")
+    os.environ["STORAGE_PROFILE"] = "sqlite"
+    os.environ["EMBEDDING_INDEX_DIR"] = os.path.join(tmp, "embeddings")
+    os.environ["SLOW_LOG_PATH"] = os.path.join(tmp, "logs", "slow_requests.log")
+    os.environ["PROFILE_DIR"] = os.path.join(tmp, "profiles")
+    if args.stub_model:
+        _install_stub_model(args.stub_latency)
+
+    from werkzeug.serving import make_server
+    from werkzeug.security import generate_password_hash
+    import app as app_module
+
+    flask_app = app_module.app
+    flask_app.config["UPLOAD_FOLDER"] = os.path.join(tmp, "uploads")
+    flask_app.config["LEAF_UPLOAD_FOLDER"] = os.path.join(tmp, "uploads", "leaves")
+    os.makedirs(flask_app.config["LEAF_UPLOAD_FOLDER"], exist_ok=True)
+    with flask_app.app_context():
+        if not app_module.User.query.filter_by(email=args.email).first():
+            app_module.db.session.add(app_module.User(
+                name="Load Test", email=args.email, email_verified=True,
+                password_hash=generate_password_hash(args.password),
+            ))
+            app_module.db.session.commit()
+        # /soil-data 404s until a device has posted; seed one reading so that
+        # warm-up doesn't show up as dashboard errors on short runs.
+        if not app_module.SensorReading.query.first():
+            app_module.save_sensor_row(app_module.db, app_module.SensorReading, esp_payload())
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # no per-request access log
+    server = make_server("127.0.0.1", args.port, flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"serving app.py on http://127.0.0.1:{server.server_port} (data in {tmp})")
+    return f"http://127.0.0.1:{server.server_port}", server
+
+# -----------------------------------------------------------------------------
+# Main
+# -----------------------------------------------------------------------------
+def print_report(rows, elapsed):
+    print(f"\n{elapsed:.1f}s run")
+    header = f"{'endpoint':<28}{'reqs':>8}{'rps':>9}{'err%':>8}{'p50ms':>9}{'p90ms':>9}{'p99ms':>9}{'maxms':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in rows:
+        print(f"{r['endpoint']:<28}{r['requests']:>8}{r['rps']:>9.1f}{r['error_rate'] * 100:>8.2f}"
+              f"{r['p50_ms']:>9.1f}{r['p90_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['max_ms']:>9.1f}")
+    for r in rows:
+        if r["first_error"]:
+            print(f"  first error on {r['endpoint']}: {r['first_error']}")
+    total = sum(r["requests"] for r in rows)
+    errors = sum(r["errors"] for r in rows)
+    if total:
+        print(f"total: {total} requests, {total / elapsed:.1f} req/s, {errors / total * 100:.2f}% errors")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--base-url", default="http://127.0.0.1:8000")
+    ap.add_argument("--serve", action="store_true", help="run app.py in-process on a temp DB")
+    ap.add_argument("--port", type=int, default=0, help="port for --serve (0 = any free port)")
+    ap.add_argument("--stub-model", action="store_true", help="with --serve: replace the model with a stub")
+    ap.add_argument("--stub-latency", type=float, default=0.05, help="stub model inference time (s)")
+    ap.add_argument("--devices", type=int, default=50)
+    ap.add_argument("--device-interval", type=float, default=5.0)
+    ap.add_argument("--dashboards", type=int, default=10)
+    ap.add_argument("--poll-interval", type=float, default=2.0)
+    ap.add_argument("--readings-limit", type=int, default=100)
+    ap.add_argument("--uploaders", type=int, default=1)
+    ap.add_argument("--upload-interval", type=float, default=10.0)
+    ap.add_argument("--email", default=LOADTEST_EMAIL, help="verified account used by uploaders")
+    ap.add_argument("--password", default=LOADTEST_PASSWORD)
+    ap.add_argument("--duration", type=float, default=60.0, help="seconds")
+    ap.add_argument("--timeout", type=float, default=10.0, help="per-request timeout (s)")
+    ap.add_argument("--json", help="also write the report to this file")
+    args = ap.parse_args(argv)
+
+    server = None
+    if args.serve:
+        args.base_url, server = serve(args)
+
+    stats = Stats()
+    stop = threading.Event()
+    actors = (
+        [threading.Thread(target=device, args=(args, stats, stop)) for _ in range(args.devices)]
+        + [threading.Thread(target=dashboard, args=(args, stats, stop)) for _ in range(args.dashboards)]
+        + [threading.Thread(target=uploader, args=(i, args, stats, stop)) for i in range(args.uploaders)]
+    )
+    print(f"{args.devices} devices, {args.dashboards} dashboards, {args.uploaders} uploaders "
+          f"-> {args.base_url} for {args.duration:.0f}s")
+    start = time.monotonic()
+    for t in actors:
+        t.daemon = True
+        t.start()
+    try:
+        stop.wait(args.duration)
+    except KeyboardInterrupt:
+        pass
+    stop.set()
+    elapsed = time.monotonic() - start
+    for t in actors:
+        t.join(args.timeout)
+
+    rows = stats.summary(elapsed)
+    print_report(rows, elapsed)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"elapsed_s": elapsed, "args": vars(args), "endpoints": rows}, f, indent=2)
+    if server is not None:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
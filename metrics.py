@@ -0,0 +1,234 @@
+"""
+Minimal in-process metrics with a Prometheus text endpoint (/metrics).
+
+Counters and histograms are plain Python objects guarded by a lock; an
+observation is one bisect + two additions, so they are cheap enough for the
+request, inference and SQL hot paths. Values are per process: under gunicorn
+with several workers, scrape each worker or run a single worker per target.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_observers = []
+
+# -----------------------------------------------------------------------------
+# Metric types
+# -----------------------------------------------------------------------------
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def _labels(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {labelvalues}")
+        return tuple(str(v) for v in labelvalues)
+
+    def _format_labels(self, labelvalues, extra=None):
+        pairs = list(zip(self.labelnames, labelvalues))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        body = ",".join(f'{k}="{_escape(v)}"' for k, v in pairs)
+        return "{" + body + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            items = [(k, self._snapshot(v)) for k, v in items]
+        for labelvalues, value in items:
+            lines.extend(self._render_child(labelvalues, value))
+        return lines
+
+    def _snapshot(self, value):
+        return value
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        key = self._labels(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_child(self, labelvalues, value):
+        return [f"{self.name}{self._format_labels(labelvalues)} {_num(value)}"]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        key = self._labels(labelvalues)
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            child = self._values.get(key)
+            if child is None:
+                # [per-bucket counts..., +Inf count], sum
+                child = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            child[0][idx] += 1
+            child[1] += value
+        for observer in _observers:
+            observer(self, value, key)
+
+    @contextmanager
+    def time(self, *labelvalues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def _snapshot(self, value):
+        return list(value[0]), value[1]
+
+    def _render_child(self, labelvalues, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            labels = self._format_labels(labelvalues, ("le", _num(bound)))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        cumulative += counts[-1]
+        lines.append(f"{self.name}_bucket{self._format_labels(labelvalues, ('le', '+Inf'))} {cumulative}")
+        lines.append(f"{self.name}_sum{self._format_labels(labelvalues)} {_num(total)}")
+        lines.append(f"{self.name}_count{self._format_labels(labelvalues)} {cumulative}")
+        return lines
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _num(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def add_observer(fn):
+    """Call fn(histogram, value, labelvalues) on every histogram observation."""
+    if fn not in _observers:
+        _observers.append(fn)
+
+def render_all():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# -----------------------------------------------------------------------------
+# Application metrics
+# -----------------------------------------------------------------------------
+REQUEST_SECONDS = Histogram(
+    "ricehealth_http_request_duration_seconds",
+    "HTTP request latency by route.",
+    ["method", "route"],
+)
+REQUESTS = Counter(
+    "ricehealth_http_requests_total",
+    "HTTP requests by route and status code.",
+    ["method", "route", "status"],
+)
+INFERENCE_SECONDS = Histogram(
+    "ricehealth_inference_stage_seconds",
+    "Time spent in each stage of predict_rice_disease (decode, transform, forward) by model tier; decode is tier=\"any\".",
+    ["tier", "stage"],
+)
+CASCADE_DECISIONS = Counter(
+    "ricehealth_inference_cascade_total",
+    "Cascade predictions answered by the fast tier (accepted) or passed to B4 (escalated).",
+    ["outcome"],
+)
+SIMILAR_SEARCH_SECONDS = Histogram(
+    "ricehealth_similar_search_seconds",
+    "Nearest-neighbour search time in the leaf-image embedding index.",
+    ["mode"],
+)
+DB_QUERY_SECONDS = Histogram(
+    "ricehealth_db_query_duration_seconds",
+    "SQL statement execution time by statement type.",
+    ["operation"],
+)
+DB_QUERIES = Counter(
+    "ricehealth_db_queries_total",
+    "SQL statements executed by statement type.",
+    ["operation"],
+)
+INGEST_ROWS = Counter(
+    "ricehealth_ingest_rows_total",
+    "Sensor rows stored via /api/ingest (use rate() for rows/sec).",
+)
+INGEST_SECONDS = Histogram(
+    "ricehealth_ingest_write_duration_seconds",
+    "Time to insert and commit one ingested sensor row.",
+)
+
+# -----------------------------------------------------------------------------
+# SQLAlchemy hooks
+# -----------------------------------------------------------------------------
+def _sql_operation(statement):
+    head = statement.lstrip().split(None, 1)
+    return head[0].upper() if head else "OTHER"
+
+# Start times live on the per-statement execution context, so a statement
+# that raises (no after_cursor_execute) leaves nothing behind on the
+# long-lived pooled connection.
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_metrics_start", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    operation = _sql_operation(statement)
+    DB_QUERY_SECONDS.observe(elapsed, operation)
+    DB_QUERIES.inc(operation)
+
+def instrument_sqlalchemy():
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+# -----------------------------------------------------------------------------
+# Flask wiring
+# -----------------------------------------------------------------------------
+def init_app(app):
+    """Per-route timing for every request, SQL timing, and GET /metrics."""
+    from flask import Response, g, request
+
+    instrument_sqlalchemy()
+
+    @app.before_request
+    def _start_timer():
+        g._metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        start = g.pop("_metrics_start", None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else "<unmatched>"
+            REQUEST_SECONDS.observe(time.perf_counter() - start, request.method, route)
+            REQUESTS.inc(request.method, route, response.status_code)
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(render_all(), mimetype="text/plain; version=0.0.4")
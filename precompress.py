@@ -0,0 +1,97 @@
+"""
+Build precompressed variants next to static assets so assets.send_cached()
+can pick them by content negotiation:
+
+    BG.jpg      -> BG.jpg.webp
+    app.css     -> app.css.gz, app.css.br   (.br only if `brotli` is installed)
+
+Usage:
+    python precompress.py                  # static/images, static/medicines, static/uploads
+    python precompress.py path/to/dir ...
+
+Variants are only rebuilt when the source is newer, and are dropped if they
+would not be smaller than the original.
+"""
+import gzip
+import os
+import sys
+
+from PIL import Image
+
+from config import BASE_DIR
+
+try:
+    import brotli
+except ImportError:  # optional
+    brotli = None
+
+DEFAULT_DIRS = [
+    os.path.join(BASE_DIR, "static", "images"),
+    os.path.join(BASE_DIR, "static", "medicines"),
+    os.path.join(BASE_DIR, "static", "uploads"),
+]
+TEXT_EXTS = {".css", ".js", ".svg", ".html", ".json", ".txt", ".map"}
+IMAGE_EXTS = {".jpg", ".jpeg", ".png"}
+VARIANT_EXTS = {".gz", ".br", ".webp"}
+WEBP_QUALITY = 80
+
+def _up_to_date(src, dst):
+    return os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src)
+
+def _write_if_smaller(src, dst, data):
+    if len(data) >= os.path.getsize(src):
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+    tmp = dst + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, dst)
+    return True
+
+def _webp_bytes(src):
+    from io import BytesIO
+    with Image.open(src) as img:
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+        buf = BytesIO()
+        img.save(buf, "WEBP", quality=WEBP_QUALITY, method=6)
+        return buf.getvalue()
+
+def build_variants(src):
+    """Create missing/stale variants for one file. Returns list of written paths."""
+    ext = os.path.splitext(src)[1].lower()
+    written = []
+    if ext in IMAGE_EXTS:
+        dst = src + ".webp"
+        if not _up_to_date(src, dst) and _write_if_smaller(src, dst, _webp_bytes(src)):
+            written.append(dst)
+    elif ext in TEXT_EXTS:
+        with open(src, "rb") as f:
+            raw = f.read()
+        dst = src + ".gz"
+        if not _up_to_date(src, dst) and _write_if_smaller(src, dst, gzip.compress(raw, 9, mtime=0)):
+            written.append(dst)
+        if brotli is not None:
+            dst = src + ".br"
+            if not _up_to_date(src, dst) and _write_if_smaller(src, dst, brotli.compress(raw, quality=11)):
+                written.append(dst)
+    return written
+
+def main(dirs):
+    total = 0
+    for directory in dirs:
+        for root, _, files in os.walk(directory):
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in VARIANT_EXTS:
+                    continue
+                try:
+                    for path in build_variants(os.path.join(root, name)):
+                        print("wrote", os.path.relpath(path, BASE_DIR))
+                        total += 1
+                except OSError as e:
+                    print(f"skip {name}: {e}", file=sys.stderr)
+    print(f"{total} variant(s) written")
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or DEFAULT_DIRS)
@@ -1,9 +1,13 @@
 import os
+from dataclasses import dataclass
+from typing import Any, Optional
+
 import torch
 import torchvision.transforms as transforms
 import torchvision
 from PIL import Image
-from config import BASE_DIR
+from config import BASE_DIR, DEFAULT_MODEL_TIER, CASCADE_FAST_TIER, CASCADE_THRESHOLD
+from metrics import INFERENCE_SECONDS, CASCADE_DECISIONS
 
 class_names = [
     'bacterial_leaf_blight',
@@ -18,32 +22,122 @@ class_names = [
     'tungro'
 ]
 
-_model = None
-_transform = None
+# ---- Model registry: fastest first ----
+MODEL_TIERS = {
+    "mobilenet_v3": {
+        "builder": "mobilenet_v3_large",
+        "weights": "MobileNet_V3_Large_Weights",
+        "input_size": 224,
+        "checkpoint": "best_mobilenet_v3_large.pth",
+    },
+    "b0": {
+        "builder": "efficientnet_b0",
+        "weights": "EfficientNet_B0_Weights",
+        "input_size": 224,
+        "checkpoint": "best_efficientnet_b0.pth",
+    },
+    "b4": {
+        "builder": "efficientnet_b4",
+        "weights": "EfficientNet_B4_Weights",
+        "input_size": 380,
+        "checkpoint": "best_efficientnet_b4.pth",
+    },
+}
+ACCURATE_TIER = "b4"
+CASCADE = "cascade"   # CASCADE_FAST_TIER, escalating to ACCURATE_TIER when unsure
+
+_models = {}   # tier -> (model, transform)
 _device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-def load_model():
-    global _model, _transform
-    if _model is None:
-        model_path = os.path.join(BASE_DIR, 'best_efficientnet_b4.pth')
-        weights = torchvision.models.EfficientNet_B4_Weights.IMAGENET1K_V1
-        _transform = transforms.Compose([
-            transforms.Resize((380, 380)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=weights.transforms().mean, std=weights.transforms().std),
-        ])
-        _model = torchvision.models.efficientnet_b4(weights=None)
-        _model.classifier[1] = torch.nn.Linear(_model.classifier[1].in_features, len(class_names))
-        _model.load_state_dict(torch.load(model_path, map_location=_device))
-        _model.to(_device)
-        _model.eval()
-
-def predict_rice_disease(image_path):
-    load_model()
-    image = Image.open(image_path).convert("RGB")
-    input_tensor = _transform(image).unsqueeze(0).to(_device)
-    with torch.no_grad():
-        outputs = _model(input_tensor)
+@dataclass
+class Prediction:
+    label: str
+    confidence: float          # %
+    embedding: Any             # float32 numpy vector (penultimate layer)
+    tier: str                  # tier that produced the answer
+    escalated: bool = False    # cascade fell through to ACCURATE_TIER
+
+def checkpoint_path(tier):
+    return os.path.join(BASE_DIR, MODEL_TIERS[tier]["checkpoint"])
+
+def available_tiers():
+    """Tiers whose checkpoint is on disk, plus "cascade" when both ends are."""
+    tiers = [t for t in MODEL_TIERS if os.path.exists(checkpoint_path(t))]
+    if CASCADE_FAST_TIER in tiers and ACCURATE_TIER in tiers and CASCADE_FAST_TIER != ACCURATE_TIER:
+        tiers.append(CASCADE)
+    return tiers
+
+def build_model(tier):
+    """Untrained architecture for `tier` with a len(class_names)-way head."""
+    spec = MODEL_TIERS[tier]
+    weights = getattr(torchvision.models, spec["weights"]).IMAGENET1K_V1
+    transform = transforms.Compose([
+        transforms.Resize((spec["input_size"], spec["input_size"])),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=weights.transforms().mean, std=weights.transforms().std),
+    ])
+    model = getattr(torchvision.models, spec["builder"])(weights=None)
+    model.classifier[-1] = torch.nn.Linear(model.classifier[-1].in_features, len(class_names))
+    return model, transform
+
+def load_model(tier=ACCURATE_TIER):
+    if tier not in MODEL_TIERS:
+        raise ValueError(f"Unknown model tier {tier!r}; choose one of {', '.join(MODEL_TIERS)}")
+    if tier not in _models:
+        model, transform = build_model(tier)
+        model.load_state_dict(torch.load(checkpoint_path(tier), map_location=_device))
+        model.to(_device)
+        model.eval()
+        _models[tier] = (model, transform)
+    return _models[tier]
+
+def _forward(model, input_tensor):
+    """Return (logits, penultimate-layer embedding) in one pass."""
+    x = torch.flatten(model.avgpool(model.features(input_tensor)), 1)
+    embedding = model.classifier[:-1](x)
+    return model.classifier[-1](embedding), embedding
+
+def _run_tier(tier, image):
+    model, transform = load_model(tier)
+    with INFERENCE_SECONDS.time(tier, "transform"):
+        input_tensor = transform(image).unsqueeze(0).to(_device)
+    with INFERENCE_SECONDS.time(tier, "forward"), torch.no_grad():
+        outputs, embedding = _forward(model, input_tensor)
         probs = torch.nn.functional.softmax(outputs, dim=1)
         conf, pred = torch.max(probs, 1)
-    return class_names[pred.item()], conf.item() * 100
+    return Prediction(
+        label=class_names[pred.item()],
+        confidence=conf.item() * 100,
+        embedding=embedding[0].cpu().numpy().astype("float32"),
+        tier=tier,
+    )
+
+def classify(image_path, tier: Optional[str] = None, threshold: float = CASCADE_THRESHOLD) -> Prediction:
+    """
+    Run one tier, or CASCADE: the fast tier first, then ACCURATE_TIER only if
+    its confidence is below `threshold` (%).
+    """
+    tier = tier or DEFAULT_MODEL_TIER
+    # Decoding is the same whichever tier(s) then run, so it is not split by tier.
+    with INFERENCE_SECONDS.time("any", "decode"):
+        image = Image.open(image_path).convert("RGB")
+    if tier != CASCADE:
+        return _run_tier(tier, image)
+
+    fast = _run_tier(CASCADE_FAST_TIER, image)
+    if fast.confidence >= threshold:
+        CASCADE_DECISIONS.inc("accepted")
+        return fast
+    CASCADE_DECISIONS.inc("escalated")
+    result = _run_tier(ACCURATE_TIER, image)
+    result.escalated = True
+    return result
+
+def predict_with_embedding(image_path, tier=None):
+    """Like predict_rice_disease, plus the image's float32 embedding (numpy)."""
+    result = classify(image_path, tier)
+    return result.label, result.confidence, result.embedding
+
+def predict_rice_disease(image_path, tier=None):
+    result = classify(image_path, tier)
+    return result.label, result.confidence
@@ -0,0 +1,301 @@
+"""
+On-demand profiling and slow-request capture.
+
+- Admins (config.ADMIN_EMAILS) can profile a single request by adding
+  ?_profile=cprofile or ?_profile=sample (or an X-Profile header). The result
+  is written to config.PROFILE_DIR and its name returned in X-Profile-Id:
+    *.prof    cProfile stats (snakeviz, `python -m pstats`, flameprof)
+    *.folded  collapsed stacks (flamegraph.pl, speedscope)
+- Every request over config.SLOW_REQUEST_SECONDS is appended to the slow log
+  as one JSON line: route, timing breakdown and the SQL it ran. Each process
+  writes its own file (SLOW_LOG_PATH with the pid inserted, e.g.
+  slow_requests.1234.log), since rotating a shared file across gunicorn
+  workers is not safe.
+- config.PROFILE_SAMPLE_RATE runs the sampling profiler on that fraction of
+  ordinary requests and keeps the stacks only if the request turns out slow.
+"""
+import cProfile
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+from flask import request, session
+
+import metrics
+from config import (
+    ADMIN_EMAILS, PROFILE_DIR, PROFILE_KEEP, PROFILE_SAMPLE_RATE,
+    SAMPLER_INTERVAL, SLOW_LOG_PATH, SLOW_REQUEST_SECONDS,
+)
+
+MAX_SQL_PER_REQUEST = 100
+MAX_SQL_CHARS = 500
+
+_local = threading.local()
+_cprofile_lock = threading.Lock()   # only one cProfile may be active per process
+_slow_log_lock = threading.Lock()
+_slow_log_pid = None
+slow_log = logging.getLogger("ricehealth.slow")
+
+# -----------------------------------------------------------------------------
+# Sampling profiler
+# -----------------------------------------------------------------------------
+class SampledStacks(Counter):
+    """Folded stack -> sample count for one request's thread."""
+
+    def __init__(self, thread_id):
+        super().__init__()
+        self.thread_id = thread_id
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.most_common())
+
+class StackSampler:
+    """
+    One process-wide thread that samples the stacks of registered threads
+    every `interval` seconds. Each tick takes a single sys._current_frames()
+    snapshot however many requests are being sampled, and the thread sleeps
+    while nothing is registered.
+    """
+
+    def __init__(self, interval=SAMPLER_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._targets = {}
+        self._wake = threading.Event()
+        self._thread = None
+
+    def register(self, thread_id):
+        stacks = SampledStacks(thread_id)
+        with self._lock:
+            self._targets[thread_id] = stacks
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return stacks
+
+    def unregister(self, thread_id):
+        # Sampling happens under the lock, so no samples land after this returns.
+        with self._lock:
+            self._targets.pop(thread_id, None)
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._targets:
+                    self._wake.clear()
+                    continue
+                frames = sys._current_frames()
+                for thread_id, stacks in self._targets.items():
+                    frame = frames.get(thread_id)
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                        frame = frame.f_back
+                    if stack:
+                        stacks[";".join(reversed(stack))] += 1
+                del frames
+
+_sampler = StackSampler()
+
+# -----------------------------------------------------------------------------
+# Per-request trace (stage timings + SQL)
+# -----------------------------------------------------------------------------
+class _Trace:
+    __slots__ = ("start", "stages", "sql", "sql_dropped")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.sql = []
+        self.sql_dropped = 0
+
+def _current_trace():
+    return getattr(_local, "trace", None)
+
+def _record_stage(histogram, value, labelvalues):
+    trace = _current_trace()
+    if trace is None or histogram in (metrics.REQUEST_SECONDS, metrics.DB_QUERY_SECONDS):
+        return
+    key = "/".join((histogram.name.replace("ricehealth_", "", 1),) + labelvalues)
+    trace.stages[key] = trace.stages.get(key, 0.0) + value
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context (not conn.info) so failed statements don't leak.
+    if context is not None and _current_trace() is not None:
+        context._profiling_start = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = _current_trace()
+    start = getattr(context, "_profiling_start", None)
+    if trace is None or start is None:
+        return
+    elapsed = time.perf_counter() - start
+    if len(trace.sql) < MAX_SQL_PER_REQUEST:
+        trace.sql.append((elapsed, " ".join(statement.split())[:MAX_SQL_CHARS]))
+    else:
+        trace.sql_dropped += 1
+
+# -----------------------------------------------------------------------------
+# Output
+# -----------------------------------------------------------------------------
+def _profile_name(ext):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    slug = "".join(c if c.isalnum() else "_" for c in route).strip("_") or "root"
+    stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    return f"{stamp}-{slug}-{uuid.uuid4().hex[:8]}{ext}"
+
+def _prune_profiles():
+    entries = sorted(
+        (e for e in os.scandir(PROFILE_DIR) if e.is_file()),
+        key=lambda e: e.stat().st_mtime,
+    )
+    for entry in entries[:max(0, len(entries) - PROFILE_KEEP)]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+def _save_profile(profiler):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    if isinstance(profiler, SampledStacks):
+        name = _profile_name(".folded")
+        with open(os.path.join(PROFILE_DIR, name), "w") as f:
+            f.write(profiler.folded())
+    else:
+        name = _profile_name(".prof")
+        profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+    _prune_profiles()
+    return name
+
+def _slow_log_path(pid):
+    root, ext = os.path.splitext(SLOW_LOG_PATH)
+    return f"{root}.{pid}{ext}"
+
+def _open_slow_log():
+    """(Re)open this process's slow log, e.g. in a worker forked after init_app."""
+    global _slow_log_pid
+    pid = os.getpid()
+    if _slow_log_pid == pid:
+        return
+    with _slow_log_lock:
+        if _slow_log_pid == pid:
+            return
+        for handler in list(slow_log.handlers):   # inherited from the parent process
+            slow_log.removeHandler(handler)
+            handler.close()
+        os.makedirs(os.path.dirname(SLOW_LOG_PATH), exist_ok=True)
+        handler = RotatingFileHandler(_slow_log_path(pid), maxBytes=10 * 1024 * 1024, backupCount=5)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        slow_log.addHandler(handler)
+        _slow_log_pid = pid
+
+def _log_slow(trace, duration, status, profile_name):
+    _open_slow_log()
+    sql_total = sum(elapsed for elapsed, _ in trace.sql)
+    breakdown = {key: round(value * 1000, 2) for key, value in trace.stages.items()}
+    breakdown["sql"] = round(sql_total * 1000, 2)
+    slow_log.warning(json.dumps({
+        "ts": datetime.utcnow().isoformat() + "Z",
+        "method": request.method,
+        "route": request.url_rule.rule if request.url_rule else None,
+        "path": request.path,
+        "status": status,
+        "duration_ms": round(duration * 1000, 2),
+        "breakdown_ms": breakdown,
+        "sql_count": len(trace.sql) + trace.sql_dropped,
+        "sql": [{"ms": round(elapsed * 1000, 2), "statement": stmt} for elapsed, stmt in trace.sql],
+        "profile": profile_name,
+    }))
+
+# -----------------------------------------------------------------------------
+# Flask wiring
+# -----------------------------------------------------------------------------
+def is_admin():
+    email = session.get("user_email")
+    return bool(email) and email.lower() in ADMIN_EMAILS
+
+def _requested_mode():
+    mode = request.args.get("_profile") or request.headers.get("X-Profile")
+    if mode and is_admin():
+        return "sample" if mode == "sample" else "cprofile"
+    return None
+
+def _start_profiler(mode):
+    if mode == "cprofile" and _cprofile_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    # sampling requested, or another request already holds cProfile
+    return _sampler.register(threading.get_ident())
+
+def _stop_profiler(profiler):
+    if isinstance(profiler, SampledStacks):
+        _sampler.unregister(profiler.thread_id)
+    else:
+        profiler.disable()
+        _cprofile_lock.release()
+
+def init_app(app):
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    slow_log.setLevel(logging.WARNING)
+    slow_log.propagate = False
+
+    metrics.add_observer(_record_stage)
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+    @app.before_request
+    def _start_trace():
+        _local.trace = _Trace()
+        _local.forced = False
+        _local.profiler = None
+        mode = _requested_mode()
+        if mode:
+            _local.forced = True
+            _local.profiler = _start_profiler(mode)
+        elif PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+            _local.profiler = _sampler.register(threading.get_ident())
+
+    @app.after_request
+    def _finish_trace(response):
+        trace = _current_trace()
+        if trace is None:
+            return response
+        duration = time.perf_counter() - trace.start
+        profiler = _local.profiler
+        _local.profiler = None
+        if profiler is not None:
+            _stop_profiler(profiler)
+
+        slow = duration >= SLOW_REQUEST_SECONDS
+        profile_name = None
+        if profiler is not None and (_local.forced or slow):
+            profile_name = _save_profile(profiler)
+            if _local.forced:
+                response.headers["X-Profile-Id"] = profile_name
+        if slow:
+            _log_slow(trace, duration, response.status_code, profile_name)
+        return response
+
+    @app.teardown_request
+    def _clear_trace(exc):
+        profiler = getattr(_local, "profiler", None)
+        if profiler is not None:
+            _stop_profiler(profiler)
+        _local.trace = None
+        _local.profiler = None